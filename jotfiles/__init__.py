@@ -3,22 +3,39 @@
 __version__ = __meta__.version
 
 from dataclasses import dataclass
+from typing import Optional
 
 from flask import Flask
 
+from jotfiles.container import Container
+from jotfiles.google.flask import blueprint as google_bp
 from jotfiles.jira_m.flask import blueprint as jira_bp
 from jotfiles.trello_m.flask import blueprint as trello_bp
+from jotfiles.workflow_poller import Config as Settings
 
 
 @dataclass
 class Config:
-    pass
+    # shared secret expected in the query string of JIRA webhook calls
+    JIRA_WEBHOOK_SECRET: Optional[str] = None
+    # trello app secret, used to verify the signature of trello webhook calls
+    TRELLO_WEBHOOK_SECRET: Optional[str] = None
+    # callback registered in trello, when it differs from the url flask sees
+    TRELLO_WEBHOOK_URL: Optional[str] = None
+    # token given to google when the calendar push channel was opened
+    CALENDAR_WEBHOOK_TOKEN: Optional[str] = None
 
 
-def create_app(config: Config) -> Flask:
+def create_app(config: Config, container: Optional[Container] = None) -> Flask:
     app = Flask(__name__)
     app.config.from_object(config)
+    if container is None:
+        container = Container()
+        container.config.from_pydantic(Settings())
+    # clients are created on first use and then reused by every request
+    app.extensions["jotfiles"] = container
     app.register_blueprint(trello_bp)
     app.register_blueprint(jira_bp)
+    app.register_blueprint(google_bp)
 
     return app
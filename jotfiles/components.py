@@ -20,14 +20,50 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-from typing import List
+import logging
+from datetime import datetime, timedelta
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, TypeVar
 
 from jotfiles.model import CalendarEvent, Task
 
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def chunks(items: Iterable[T], size: int) -> Iterator[List[T]]:
+    iterator = iter(items)
+    return iter(lambda: list(islice(iterator, size)), [])
+
+
+def upsert_each(
+    upsert: Callable[[T], None], items: Iterable[T], key: Callable[[T], str]
+) -> Dict[str, Optional[str]]:
+    # item key -> error, if the upsert failed
+    report = {}
+    for item in items:
+        try:
+            upsert(item)
+            report[key(item)] = None
+        except Exception as e:
+            logger.exception("Failed to upsert %s", key(item))
+            report[key(item)] = str(e)
+    return report
+
 
 class Calendar:
-    # TODO add list type
-    def list_week_events(self) -> List[CalendarEvent]:
+    def list_week_events(self) -> Iterator[CalendarEvent]:
+        pass
+
+    def team_week_events(self, calendar_ids: Iterable[str]) -> Iterator[CalendarEvent]:
+        pass
+
+    def updated_events(self) -> Iterator[CalendarEvent]:
+        # calendars that cannot track changes fall back to a full listing
+        return iter(self.list_week_events())
+
+    def commit_updates(self):
         pass
 
 
@@ -35,12 +71,30 @@ class PersonalBoard:
     def upsert_task_card(self, task: Task):
         pass
 
+    def upsert_task_cards(self, tasks: Iterable[Task]) -> Dict[str, Optional[str]]:
+        return upsert_each(self.upsert_task_card, tasks, lambda task: task.id)
+
     def upsert_calendar_card(self, event: CalendarEvent):
         pass
 
+    def upsert_calendar_cards(
+        self, events: Iterable[CalendarEvent]
+    ) -> Dict[str, Optional[str]]:
+        return upsert_each(self.upsert_calendar_card, events, lambda event: event.id)
+
+    def archive_calendar_card(self, event: CalendarEvent):
+        pass
+
     def update_done(self):
         pass
 
+    def archive_done(self, max_age: timedelta, sprint_end: Optional[datetime] = None):
+        pass
+
+    def pop_write_stats(self) -> Dict[str, int]:
+        # write calls performed and avoided since the previous call
+        return {}
+
 
 # TODO change name
 class Workflow:
@@ -52,3 +106,6 @@ def send_scheduled_messages(self):
 
     def update_events(self):
         pass
+
+    def archive_done(self, max_age: timedelta):
+        pass
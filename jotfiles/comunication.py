@@ -20,9 +20,11 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-from dataclasses import dataclass
+import hashlib
+from concurrent.futures import Future
+from dataclasses import astuple, dataclass, field
 from datetime import datetime
-from typing import List, Optional
+from typing import List, Optional, Set
 
 
 @dataclass
@@ -32,16 +34,51 @@ class Message:
     thread: Optional[str]
 
 
+@dataclass
+class DigestMessage(Message):
+    # the merged messages, content holds them as plain text
+    parts: List[str] = field(default_factory=list)
+
+
 @dataclass
 class ScheduledMessage(Message):
     schedule: datetime
+    id: Optional[str] = None
+
+
+def message_key(message: ScheduledMessage) -> str:
+    # an edited message gets a new key, as if it was a new one
+    content = "|".join(map(str, astuple(message)))
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+@dataclass
+class MessagesPoll:
+    # messages not returned by a previous poll
+    new: List[ScheduledMessage]
+    # keys of messages returned before, and deleted or edited since
+    gone: Set[str] = field(default_factory=set)
 
 
 class ScheduledMessagesPool:
     def list_messages(self) -> List[ScheduledMessage]:
         pass
 
+    def poll_messages(self) -> MessagesPoll:
+        # pools that cannot track messages return all of them every time
+        return MessagesPoll(self.list_messages())
+
 
 class Chat:
     def send_message(self, message: Message):
         pass
+
+    def submit_message(self, message: Message) -> Future:
+        # chats that cannot send in the background send before returning
+        future = Future()
+        try:
+            self.send_message(message)
+            future.set_result(None)
+        except Exception as e:
+            future.set_exception(e)
+        return future
@@ -20,24 +20,33 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
+from datetime import timedelta
+
 from dependency_injector import containers, providers
+from flask import current_app
 
-from jotfiles.components import PersonalBoard
+from jotfiles.components import Calendar, PersonalBoard
 from jotfiles.comunication import Chat, ScheduledMessagesPool
-from jotfiles.google import GChat
+from jotfiles.dispatch import MessageDispatcher, SentLedger
+from jotfiles.google import SCOPES, GChat, GoogleCalendar
+from jotfiles.google.credentials import CredentialsManager
 from jotfiles.jira_m import Config as JIRAConfig
 from jotfiles.jira_m import JiraScrumBoard
 from jotfiles.jira_m import load_from_file as load_jira_from_file
 from jotfiles.scrum import ScrumBoard
+from jotfiles.state import JsonState
 from jotfiles.trello_m import TrelloPersonalBoard, TrelloScheduledMessagesPool
 from jotfiles.trello_m import load_from_file as load_trello_from_file
+from jotfiles.trello_m.store import CardStore
 from jotfiles.workflow_hooks import LocalWorkflow
 
 
 def load_personal_space(config, trello_client, trello_config) -> PersonalBoard:
     personal_board = config["personal_board"]
     if personal_board == "trello":
-        return TrelloPersonalBoard(trello_client(), trello_config.board_id)
+        return TrelloPersonalBoard(
+            trello_client(), trello_config.board_id, CardStore(config["trello_store"])
+        )
     else:
         raise ValueError(f"Unknown personal space type {personal_board}")
 
@@ -46,16 +55,20 @@ def load_scrum_board(config, jira_config) -> ScrumBoard:
 
     scrum_board = config["scrum_board"]
     if scrum_board == "jira":
-        return JiraScrumBoard(jira_config)
+        return JiraScrumBoard(
+            jira_config,
+            JsonState(config["jira_watermarks"]),
+            timedelta(hours=config["jira_reconcile_hours"]),
+        )
     else:
         raise ValueError(f"Unknown scrum board type {scrum_board}")
 
 
-def load_smpool(config, trello_client) -> ScheduledMessagesPool:
+def load_smpool(config, trello_client, trello_config) -> ScheduledMessagesPool:
 
     smpool = config["smpool"]
     if smpool == "trello":
-        return TrelloScheduledMessagesPool(trello_client())
+        return TrelloScheduledMessagesPool(trello_client(), [trello_config.board_id])
     else:
         raise ValueError(f"Unknown scheduled messages pool type {smpool}")
 
@@ -69,30 +82,77 @@ def load_chat(config) -> Chat:
         raise ValueError(f"Unknown chat type {chat}")
 
 
+def load_calendar(config, google_credentials) -> Calendar:
+
+    calendar = config["calendar"]
+    if calendar == "google":
+        return GoogleCalendar(
+            config["calendar_email"],
+            JsonState(config["calendar_sync_state"]),
+            timedelta(hours=config["calendar_reconcile_hours"]),
+            google_credentials,
+        )
+    else:
+        raise ValueError(f"Unknown calendar type {calendar}")
+
+
+def load_dispatcher(config, chat) -> MessageDispatcher:
+    ledger = SentLedger(JsonState(config["sent_ledger"]))
+    window = config["message_coalesce_seconds"]
+    return MessageDispatcher(
+        chat, ledger, timedelta(seconds=window) if window else None
+    )
+
+
+# all singletons are thread safe, as the flask app shares them between requests
 class Container(containers.DeclarativeContainer):
 
     config = providers.Configuration()
 
-    trello_config = providers.Singleton(
+    trello_config = providers.ThreadSafeSingleton(
         load_trello_from_file, config.trello_credentials
     )
 
-    trello_client = providers.Singleton(trello_config.provided.create_client)
+    trello_client = providers.ThreadSafeSingleton(trello_config.provided.create_client)
 
-    personal_board = providers.Singleton(
+    personal_board = providers.ThreadSafeSingleton(
         load_personal_space, config, trello_client, trello_config
     )
 
-    jira_config: JIRAConfig = providers.Singleton(
+    jira_config: JIRAConfig = providers.ThreadSafeSingleton(
         load_jira_from_file, config.jira_credentials
     )
 
-    scrum_board = providers.Singleton(load_scrum_board, config, jira_config)
+    scrum_board = providers.ThreadSafeSingleton(load_scrum_board, config, jira_config)
 
-    smpool = providers.Singleton(load_smpool, config, trello_client)
+    smpool = providers.ThreadSafeSingleton(
+        load_smpool, config, trello_client, trello_config
+    )
 
-    chat = providers.Singleton(load_chat, config)
+    chat = providers.ThreadSafeSingleton(load_chat, config)
 
-    workflow = providers.Singleton(
-        LocalWorkflow, scrum_board, personal_board, smpool, chat
+    # one set of google credentials, refreshed in the background, for all services
+    google_credentials = providers.ThreadSafeSingleton(
+        CredentialsManager,
+        SCOPES,
+        config.google_token,
+        config.google_client_secrets,
     )
+
+    calendar = providers.ThreadSafeSingleton(load_calendar, config, google_credentials)
+
+    dispatcher = providers.ThreadSafeSingleton(load_dispatcher, config, chat)
+
+    workflow = providers.ThreadSafeSingleton(
+        LocalWorkflow,
+        scrum_board,
+        personal_board,
+        smpool,
+        chat,
+        calendar,
+        dispatcher=dispatcher,
+    )
+
+
+def current_container() -> Container:
+    return current_app.extensions["jotfiles"]
@@ -0,0 +1,235 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+
+from jotfiles.comunication import (
+    Chat,
+    DigestMessage,
+    Message,
+    ScheduledMessage,
+    message_key,
+)
+from jotfiles.state import JsonState
+
+logger = logging.getLogger(__name__)
+retry_delay = timedelta(minutes=1)
+max_attempts = 5
+
+
+def _transient(error: BaseException) -> bool:
+    # unknown recipients or rejected messages fail the same way on every retry
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+class SentLedger:
+    """Persistent record of the scheduled messages already delivered."""
+
+    def __init__(self, state: JsonState):
+        self.state = state
+
+    def sent(self, message: ScheduledMessage) -> bool:
+        return self.state.get(message_key(message)) is not None
+
+    def record(self, message: ScheduledMessage):
+        self.state.put(message_key(message), datetime.now().isoformat())
+
+    def forget(self, message: ScheduledMessage):
+        self.state.remove(message_key(message))
+
+
+class MessageDispatcher:
+    """Sends scheduled messages from a background thread, once each, on time."""
+
+    def __init__(
+        self,
+        chat: Chat,
+        ledger: SentLedger,
+        coalesce_window: Optional[timedelta] = None,
+    ):
+        self.chat = chat
+        self.ledger = ledger
+        # messages to the same thread due within this window are sent as one
+        self.coalesce_window = coalesce_window
+        # (schedule, insertion order, message), the earliest message on top
+        self._queue: List[Tuple[datetime, int, ScheduledMessage]] = []
+        self._queued: Set[str] = set()
+        # key -> failed deliveries of the message
+        self._attempts: Dict[str, int] = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self._thread = threading.Thread(
+                target=self._run, name="message-dispatcher", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def schedule(self, message: ScheduledMessage):
+        key = message_key(message)
+        with self._condition:
+            if key in self._queued or self.ledger.sent(message):
+                return
+            self._push(message.schedule, message)
+            self._queued.add(key)
+
+    def cancel(self, keys: Set[str]):
+        with self._condition:
+            keys = keys & self._queued
+            if not keys:
+                return
+            self._queue = [
+                entry for entry in self._queue if message_key(entry[2]) not in keys
+            ]
+            heapq.heapify(self._queue)
+            self._queued -= keys
+            for key in keys:
+                self._attempts.pop(key, None)
+            self._condition.notify()
+
+    def pending(self) -> int:
+        with self._condition:
+            return len(self._queue)
+
+    def _push(self, when: datetime, message: ScheduledMessage):
+        heapq.heappush(self._queue, (when, next(self._counter), message))
+        # the new message may be due before the one the thread waits for
+        self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                messages = self._next_due()
+                if not messages:
+                    return
+            self._deliver(messages)
+
+    def _next_due(self) -> List[ScheduledMessage]:
+        while not self._stopped:
+            if not self._queue:
+                self._condition.wait()
+                continue
+            when, _, message = self._queue[0]
+            delay = (when - datetime.now()).total_seconds()
+            if delay > 0:
+                self._condition.wait(delay)
+                continue
+            heapq.heappop(self._queue)
+            if self.coalesce_window is None:
+                return [message]
+            return [message, *self._pop_same_thread(message, when)]
+        return []
+
+    def _pop_same_thread(
+        self, message: ScheduledMessage, when: datetime
+    ) -> List[ScheduledMessage]:
+        merged = []
+        others = []
+        limit = when + self.coalesce_window
+        while self._queue and self._queue[0][0] <= limit:
+            entry = heapq.heappop(self._queue)
+            other = entry[2]
+            if (other.recipient, other.thread) == (message.recipient, message.thread):
+                merged.append(other)
+            else:
+                others.append(entry)
+        for entry in others:
+            heapq.heappush(self._queue, entry)
+        return merged
+
+    def _deliver(self, messages: List[ScheduledMessage]):
+        # recorded first, a crash while sending must not lead to a second delivery
+        for message in messages:
+            self.ledger.record(message)
+        first = messages[0]
+        logger.info("Sending %s messages to %s", len(messages), first.recipient)
+        outgoing: Message = first
+        if len(messages) > 1:
+            parts = [message.content for message in messages]
+            outgoing = DigestMessage(
+                "\n\n".join(parts), first.recipient, first.thread, parts
+            )
+        try:
+            future = self.chat.submit_message(outgoing)
+        except Exception as e:
+            self._failed(messages, e)
+            return
+        # slow chats send in the background, without holding later messages
+        future.add_done_callback(partial(self._delivered, messages))
+
+    def _delivered(self, messages: List[ScheduledMessage], future: Future):
+        error = future.exception()
+        if error is not None:
+            self._failed(messages, error)
+            return
+        with self._condition:
+            for message in messages:
+                key = message_key(message)
+                self._queued.discard(key)
+                self._attempts.pop(key, None)
+
+    def _failed(self, messages: List[ScheduledMessage], error: BaseException):
+        recipient = messages[0].recipient
+        logger.error("Failed to send messages to %s", recipient, exc_info=error)
+        for message in messages:
+            self.ledger.forget(message)
+        retry_at = datetime.now() + retry_delay
+        with self._condition:
+            for message in messages:
+                key = message_key(message)
+                if key not in self._queued:
+                    # cancelled while it was being sent
+                    continue
+                attempts = self._attempts.get(key, 0) + 1
+                if _transient(error) and attempts < max_attempts:
+                    self._attempts[key] = attempts
+                    self._push(retry_at, message)
+                    continue
+                logger.warning("Dropping message %s to %s", key, recipient)
+                self._queued.discard(key)
+                self._attempts.pop(key, None)
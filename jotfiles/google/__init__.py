@@ -20,27 +20,52 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
+import heapq
 import json
 import logging
-import os.path
-import pickle
-from datetime import datetime, timedelta
-from typing import Any, Dict, List
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
 
+import httplib2
 import requests
 from furl import furl
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
+from google.auth.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import Resource, build
+from googleapiclient.errors import HttpError
 
-from jotfiles.components import Calendar
-from jotfiles.comunication import Chat, Message
+from jotfiles.components import Calendar, chunks
+from jotfiles.comunication import Chat, DigestMessage, Message
+from jotfiles.google.credentials import CredentialsManager
+from jotfiles.http import retry_after
 from jotfiles.model import CalendarEvent
+from jotfiles.state import JsonState
 
 logger = logging.getLogger(__name__)
+# google chat accepts one message per second in each space
+space_interval = 1.0
+retry_statuses = {429, 500, 502, 503, 504}
+# only what CalendarEvent, and the attendance check, need from each event
+event_fields = (
+    "nextPageToken,nextSyncToken,"
+    "items(id,status,summary,start,end,attendees(self,email,responseStatus))"
+)
+# services built by google_service, shared by the whole process
+_services: Dict[Tuple[str, str], Resource] = {}
+_services_lock = threading.Lock()
+# httplib2 is not thread safe, so each thread sends requests through its own
+_transports = threading.local()
+# requests google accepts in a single batch
+calendar_batch_limit = 50
+# push channels are replaced when they get this close to their expiration
+watch_renew_margin = timedelta(days=1)
 
-
-# If modifying these scopes, delete the file token.pickle.
+# If modifying these scopes, delete the google token cache.
 SCOPES = [
     "https://www.googleapis.com/auth/documents.readonly",
     "https://www.googleapis.com/auth/drive.file",
@@ -48,11 +73,39 @@
 ]
 
 
+def _render(message: Message) -> Dict[str, Any]:
+    if not isinstance(message, DigestMessage):
+        return {"text": message.content}
+    # a digest becomes a single card, with one section per merged message
+    sections = [
+        {"widgets": [{"textParagraph": {"text": part}}]} for part in message.parts
+    ]
+    header = {"title": f"{len(message.parts)} scheduled messages"}
+    return {"cards": [{"header": header, "sections": sections}]}
+
+
 class GChat(Chat):
-    def __init__(self, recipients: Dict[str, furl]):
+    def __init__(
+        self,
+        recipients: Dict[str, furl],
+        timeout: Tuple[float, float] = (5, 30),
+        max_retries: int = 4,
+    ):
         self.recipients = recipients
+        self.timeout = timeout
+        self.max_retries = max_retries
+        # keeps connections to the webhooks alive between messages
+        self.session = requests.Session()
+        self.session.headers["Content-Type"] = "application/json; charset=UTF-8"
+        # one thread per space, so messages to a space are posted in order
+        self._senders: Dict[str, ThreadPoolExecutor] = {}
+        self._last_sent: Dict[str, float] = {}
+        self._lock = threading.Lock()
 
     def send_message(self, message: Message):
+        self.submit_message(message).result()
+
+    def submit_message(self, message: Message) -> Future:
         recipient = message.recipient
         if recipient not in self.recipients:
             raise ValueError(
@@ -60,82 +113,327 @@ def send_message(self, message: Message):
                 f"{self.recipients.keys()}"
             )
         webhook = self.recipients[recipient]
-        self._send_message({"text": message.content}, message.thread, webhook)
+        return self._sender(webhook).submit(
+            self._send_message, _render(message), message.thread, webhook
+        )
+
+    def _sender(self, webhook: furl) -> ThreadPoolExecutor:
+        space = str(webhook.path)
+        with self._lock:
+            if space not in self._senders:
+                self._senders[space] = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix="gchat"
+                )
+            return self._senders[space]
 
     def _send_message(self, message: Any, thread_key: str, webhook: furl):
         logger.debug("Sending message: %s", message)
         query = {"threadKey": thread_key}
-        r = requests.post(
-            str(webhook),
-            params=query,
-            data=json.dumps(message),
-            headers={"Content-Type": "application/json; charset=UTF-8"},
-        )
-        logger.debug("Message sent: %s", r.text)
+        for attempt in range(self.max_retries + 1):
+            self._wait_turn(webhook)
+            try:
+                r = self.session.post(
+                    str(webhook),
+                    params=query,
+                    data=json.dumps(message),
+                    timeout=self.timeout,
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.max_retries:
+                    raise
+                logger.warning("Failed to reach %s, retrying", webhook.path)
+                time.sleep(2**attempt)
+                continue
+            if r.status_code in retry_statuses and attempt < self.max_retries:
+                delay = retry_after(r)
+                if delay is None:
+                    delay = float(2**attempt)
+                logger.warning(
+                    "Chat answered %s, retrying in %ss", r.status_code, delay
+                )
+                time.sleep(delay)
+                continue
+            r.raise_for_status()
+            logger.debug("Message sent: %s", r.text)
+            return
+
+    def _wait_turn(self, webhook: furl):
+        # only the sender thread of the space touches its entry
+        space = str(webhook.path)
+        wait = self._last_sent.get(space, 0) + space_interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._last_sent[space] = time.monotonic()
+
+
+def _parse_time(raw: Dict[str, str]) -> datetime:
+    # all day events only have a date
+    value = raw.get("dateTime") or raw["date"]
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.astimezone()
+
+
+def _to_event(raw: Dict[str, Any], attending: bool = True) -> CalendarEvent:
+    cancelled = raw.get("status") == "cancelled" or not attending
+    if "start" not in raw:
+        # changes to cancelled events only carry their id
+        return CalendarEvent(raw["id"], "", datetime.min, timedelta(), cancelled)
+    start = _parse_time(raw["start"])
+    return CalendarEvent(
+        raw["id"],
+        raw.get("summary", ""),
+        start,
+        _parse_time(raw["end"]) - start,
+        cancelled,
+    )
+
+
+def google_service(name: str, version: str, credentials: Credentials) -> Resource:
+    # built once per process, from the discovery documents shipped with the client
+    with _services_lock:
+        key = (name, version)
+        if key not in _services:
+            started = time.perf_counter()
+            _services[key] = build(
+                name,
+                version,
+                credentials=credentials,
+                static_discovery=True,
+                cache_discovery=False,
+            )
+            elapsed = (time.perf_counter() - started) * 1000
+            logger.info("Built %s %s service in %.1fms", name, version, elapsed)
+        return _services[key]
+
+
+def authorized_http(credentials: Credentials) -> AuthorizedHttp:
+    # requests of shared services are executed with the transport of the thread
+    http = getattr(_transports, "http", None)
+    if http is None or http.credentials is not credentials:
+        http = AuthorizedHttp(credentials, http=httplib2.Http())
+        _transports.http = http
+    return http
+
+
+def _attending(raw: Dict[str, Any], calendar_id: str) -> bool:
+    # the same rule for every calendar, whether it is listed alone or in a batch
+    for attendee in raw.get("attendees", []):
+        if attendee.get("email", "").lower() == calendar_id.lower():
+            return attendee.get("responseStatus") == "accepted"
+    # events without guests are the owner's own
+    return True
 
 
 class GoogleCalendar(Calendar):
-    def __init__(self, email):
+    def __init__(
+        self,
+        email,
+        sync_state: Optional[JsonState] = None,
+        reconcile_every: timedelta = timedelta(days=1),
+        credentials: Optional[CredentialsManager] = None,
+    ):
         self.email = email
+        self.credentials = credentials or CredentialsManager(SCOPES)
+        self.sync_state = sync_state
+        self.reconcile_every = reconcile_every
+        # sync state not yet confirmed by the caller
+        self._pending: Optional[Dict[str, str]] = None
+        # push channel opened by watch, kept to stop it once it is replaced
+        self._channel: Optional[Dict[str, str]] = None
 
-        self.creds = None
-        # The file token.pickle stores the user's access and refresh tokens, and is
-        # created automatically when the authorization flow completes for the first
-        # time.
-        if os.path.exists("token.pickle"):
-            with open("token.pickle", "rb") as token:
-                self.creds = pickle.load(token)
-        # If there are no (valid) credentials available, let the user log in.
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    "credentials.json", SCOPES
-                )
-                self.creds = flow.run_local_server(port=6497)
-            # Save the credentials for the next run
-            with open("token.pickle", "wb") as token:
-                pickle.dump(self.creds, token)
+    @property
+    def calendar_service(self) -> Resource:
+        # loading credentials may ask the user to log in, so it waits until google
+        # is actually called
+        return google_service("calendar", "v3", self.credentials.credentials())
 
-        self.docs_service = build("docs", "v1", credentials=self.creds)
-        self.calendar_service = build("calendar", "v3", credentials=self.creds)
+    @property
+    def http(self) -> AuthorizedHttp:
+        return authorized_http(self.credentials.credentials())
 
     # TODO add list type
     def list_calendars(self) -> List:
-        events_result = self.calendar_service.calendarList().list().execute()
+        events_result = (
+            self.calendar_service.calendarList().list().execute(http=self.http)
+        )
         return events_result.get("items", [])
 
-    def list_week_events(self) -> List[CalendarEvent]:
-        # Call the Calendar API
-        now = datetime.utcnow().isoformat() + "Z"  # 'Z' indicates UTC time
-        timeMax = (datetime.utcnow() + timedelta(days=7)).isoformat() + "Z"
-        print("Getting the upcoming 10 events")
-        events_result = (
+    def updated_events(self) -> Iterator[CalendarEvent]:
+        if self.sync_state is None:
+            yield from self.list_week_events()
+            return
+
+        now = datetime.now(timezone.utc)
+        window_end = now + timedelta(days=7)
+        state = self.sync_state.get(self.email) or {}
+        reconciled = now
+        token = None
+        if state.get("token"):
+            last_reconcile = datetime.fromisoformat(state["reconciled"])
+            if now - last_reconcile < self.reconcile_every:
+                token = state["token"]
+                reconciled = last_reconcile
+
+        try:
+            pages = self._event_pages(token, now, window_end)
+            items = list(chain.from_iterable(page.get("items", []) for page in pages))
+        except HttpError as e:
+            if e.resp.status != 410:
+                raise
+            # the token expired, only a full sync yields a new one
+            logger.info("Sync token of %s expired, listing all events", self.email)
+            reconciled = now
+            pages = self._event_pages(None, now, window_end)
+            items = list(chain.from_iterable(page.get("items", []) for page in pages))
+
+        for item in items:
+            event = _to_event(item, _attending(item, self.email))
+            if event.cancelled:
+                yield event
+            # changes reach events at any date, only those in the listed window
+            # count, later ones are picked up by the next full sync
+            elif now < event.start + event.duration and event.start < window_end:
+                yield event
+        self._pending = {
+            "token": pages[-1]["nextSyncToken"],
+            "reconciled": reconciled.isoformat(),
+        }
+
+    def commit_updates(self):
+        if self.sync_state is not None and self._pending is not None:
+            self.sync_state.put(self.email, self._pending)
+            self._pending = None
+
+    def watch(self, address: str, token: Optional[str] = None) -> Dict[str, Any]:
+        # google pushes a notification to address whenever an event changes
+        previous = self._current_channel()
+        body = {"id": str(uuid.uuid4()), "type": "web_hook", "address": address}
+        if token:
+            body["token"] = token
+        channel = (
             self.calendar_service.events()
-            .list(
-                calendarId=self.email,
-                timeMin=now,
-                timeMax=timeMax,
-                maxAttendees=10,
-                singleEvents=True,
-                orderBy="startTime",
-            )
-            .execute()
+            .watch(calendarId=self.email, body=body)
+            .execute(http=self.http)
         )
-        attended_events = []
-        for event in events_result.get("items", []):
-            for attendee in event["attendees"]:
-                if (
-                    attendee["email"] == self.email
-                    and attendee["responseStatus"] == "accepted"
-                ):
-                    # TODO fix type
-                    attended_events.append(event)
-                    break
-        return attended_events
-        # if not events:
-        #     print('No upcoming events found.')
-        # for event in events:
-        #     start = event['start'].get('dateTime', event['start'].get('date'))
-        #     print(start, event['summary'])
+        logger.info("Watching %s until %s", self.email, channel.get("expiration"))
+        self._channel = {
+            "id": channel["id"],
+            "resourceId": channel["resourceId"],
+            "expiration": channel.get("expiration"),
+            "address": address,
+        }
+        if self.sync_state is not None:
+            self.sync_state.put(f"channel:{self.email}", self._channel)
+        # stopped after the new one is open, so no change goes unnoticed
+        if previous is not None:
+            self._stop_channel(previous)
+        return channel
+
+    def renew_watch(self, address: str, token: Optional[str] = None):
+        channel = self._current_channel()
+        if channel is not None and channel["address"] == address:
+            expiration = channel.get("expiration")
+            if expiration:
+                expires = datetime.fromtimestamp(int(expiration) / 1000, timezone.utc)
+                if expires - datetime.now(timezone.utc) > watch_renew_margin:
+                    return
+        self.watch(address, token)
+
+    def _current_channel(self) -> Optional[Dict[str, str]]:
+        # the channel outlives the process, so it is also kept in the sync state
+        if self._channel is None and self.sync_state is not None:
+            self._channel = self.sync_state.get(f"channel:{self.email}")
+        return self._channel
+
+    def _stop_channel(self, channel: Dict[str, str]):
+        body = {"id": channel["id"], "resourceId": channel["resourceId"]}
+        try:
+            self.calendar_service.channels().stop(body=body).execute(http=self.http)
+            logger.info("Stopped channel %s of %s", channel["id"], self.email)
+        except HttpError as e:
+            # expired channels are already gone
+            logger.warning("Failed to stop channel %s: %s", channel["id"], e)
+
+    def _event_pages(
+        self, token: Optional[str], time_min: datetime, time_max: datetime
+    ) -> List[Dict[str, Any]]:
+        if token:
+            # only changes since the token, including cancelled events
+            return list(self._pages(syncToken=token))
+        return list(
+            self._pages(timeMin=time_min.isoformat(), timeMax=time_max.isoformat())
+        )
+
+    def _pages(self, **query: Any) -> Iterator[Dict[str, Any]]:
+        request = self.calendar_service.events().list(
+            calendarId=self.email,
+            singleEvents=True,
+            # with more guests, only the calendar owner is returned
+            maxAttendees=1,
+            fields=event_fields,
+            **query,
+        )
+        while request is not None:
+            page = request.execute(http=self.http)
+            yield page
+            request = self.calendar_service.events().list_next(request, page)
+
+    def team_week_events(self, calendar_ids: Iterable[str]) -> Iterator[CalendarEvent]:
+        now = datetime.now(timezone.utc)
+        query = {
+            "singleEvents": True,
+            "orderBy": "startTime",
+            "timeMin": now.isoformat(),
+            "timeMax": (now + timedelta(days=7)).isoformat(),
+            "fields": event_fields,
+        }
+        # calendar id -> query of its next page
+        pending = {calendar_id: dict(query) for calendar_id in calendar_ids}
+        items: Dict[str, List[Dict[str, Any]]] = {key: [] for key in pending}
+        while pending:
+            pending = self._batch_pages(pending, items)
+        # each calendar is already sorted by start
+        streams = [
+            [_to_event(item) for item in calendar_items if _attending(item, key)]
+            for key, calendar_items in items.items()
+        ]
+        return heapq.merge(*streams, key=lambda event: event.start)
+
+    def _batch_pages(
+        self,
+        queries: Dict[str, Dict[str, Any]],
+        items: Dict[str, List[Dict[str, Any]]],
+    ) -> Dict[str, Dict[str, Any]]:
+        next_pages = {}
+
+        def collect(calendar_id, response, exception):
+            if exception is not None:
+                logger.warning(
+                    "Failed to list events of %s: %s", calendar_id, exception
+                )
+                return
+            items[calendar_id].extend(response.get("items", []))
+            if "nextPageToken" in response:
+                next_pages[calendar_id] = dict(
+                    queries[calendar_id], pageToken=response["nextPageToken"]
+                )
+
+        for chunk in chunks(queries.items(), calendar_batch_limit):
+            # a single round trip for up to 50 calendars
+            batch = self.calendar_service.new_batch_http_request(callback=collect)
+            for calendar_id, query in chunk:
+                request = self.calendar_service.events().list(
+                    calendarId=calendar_id, **query
+                )
+                batch.add(request, request_id=calendar_id)
+            batch.execute(http=self.http)
+        return next_pages
+
+    def list_week_events(self) -> Iterator[CalendarEvent]:
+        now = datetime.now(timezone.utc)
+        time_max = now + timedelta(days=7)
+        logger.debug("Listing events of %s until %s", self.email, time_max)
+        for page in self._pages(timeMin=now.isoformat(), timeMax=time_max.isoformat()):
+            for item in page.get("items", []):
+                if _attending(item, self.email):
+                    yield _to_event(item)
@@ -0,0 +1,130 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import logging
+import os
+import pickle
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Optional
+
+from google.auth.exceptions import RefreshError, TransportError
+from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
+from google_auth_oauthlib.flow import InstalledAppFlow
+
+logger = logging.getLogger(__name__)
+default_token_path = Path("google_token.json")
+default_secrets_path = Path("credentials.json")
+# token cache of older versions, moved to the json cache on first use
+legacy_token_path = Path("token.pickle")
+retry_interval = timedelta(minutes=1)
+
+
+class CredentialsManager:
+    """Google credentials shared by every service, refreshed before they expire."""
+
+    def __init__(
+        self,
+        scopes: List[str],
+        token_path: Path = default_token_path,
+        secrets_path: Path = default_secrets_path,
+        refresh_margin: timedelta = timedelta(minutes=5),
+    ):
+        self.scopes = scopes
+        self.token_path = token_path
+        self.secrets_path = secrets_path
+        self.refresh_margin = refresh_margin
+        self._creds: Optional[Credentials] = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresher: Optional[threading.Thread] = None
+
+    def credentials(self) -> Credentials:
+        with self._lock:
+            if self._creds is None:
+                self._creds = self._load()
+                # from now on the token is renewed before anyone finds it expired
+                self._refresher = threading.Thread(
+                    target=self._refresh_loop, name="google-credentials", daemon=True
+                )
+                self._refresher.start()
+            return self._creds
+
+    def cached(self) -> bool:
+        # without a cache, loading credentials waits for a browser login
+        return self.token_path.exists() or legacy_token_path.exists()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _load(self) -> Credentials:
+        creds = None
+        if self.token_path.exists():
+            creds = Credentials.from_authorized_user_file(
+                str(self.token_path), self.scopes
+            )
+        elif legacy_token_path.exists():
+            logger.info("Moving %s to %s", legacy_token_path, self.token_path)
+            with legacy_token_path.open("rb") as token:
+                creds = pickle.load(token)
+            self._save(creds)
+            legacy_token_path.unlink()
+        if creds and creds.valid:
+            return creds
+        if creds and creds.expired and creds.refresh_token:
+            creds.refresh(Request())
+        else:
+            flow = InstalledAppFlow.from_client_secrets_file(
+                str(self.secrets_path), self.scopes
+            )
+            creds = flow.run_local_server(port=6497)
+        self._save(creds)
+        return creds
+
+    def _save(self, creds: Credentials):
+        # the cache holds a refresh token, so only the owner may read it
+        tmp = self.token_path.with_suffix(self.token_path.suffix + ".tmp")
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(creds.to_json())
+        os.replace(tmp, self.token_path)
+
+    def _refresh_loop(self):
+        while not self._stopped.wait(self._next_refresh().total_seconds()):
+            try:
+                with self._lock:
+                    logger.debug("Refreshing google credentials")
+                    self._creds.refresh(Request())
+                    self._save(self._creds)
+            except (RefreshError, TransportError):
+                logger.exception("Failed to refresh google credentials")
+                self._stopped.wait(retry_interval.total_seconds())
+
+    def _next_refresh(self) -> timedelta:
+        expiry = self._creds.expiry
+        if expiry is None:
+            # tokens without expiry never need a refresh, check again later
+            return timedelta(hours=1)
+        # google-auth keeps expiry as a naive utc datetime
+        return max(timedelta(), expiry - self.refresh_margin - datetime.utcnow())
@@ -0,0 +1,47 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import hmac
+import logging
+
+from flask import Blueprint, abort, current_app, request
+
+from jotfiles.container import current_container
+
+logger = logging.getLogger(__name__)
+blueprint = Blueprint("google", __name__, url_prefix="/google")
+
+
+@blueprint.route("/calendar/notifications", methods=["POST"])
+def calendar_notification():
+    # the token is the one given when the channel was opened
+    secret = current_app.config.get("CALENDAR_WEBHOOK_TOKEN")
+    token = request.headers.get("X-Goog-Channel-Token", "")
+    if secret and not hmac.compare_digest(token, secret):
+        abort(403)
+
+    state = request.headers.get("X-Goog-Resource-State")
+    logger.info("Received calendar notification %s", state)
+    # the first notification of a channel only confirms it was created
+    if state == "exists":
+        current_container().workflow().update_events()
+    return "", 200
@@ -21,21 +21,31 @@
 #  SOFTWARE.
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone, tzinfo
 from getpass import getpass
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
+from dateutil import tz
 from furl import furl
 from jira import JIRA, Issue
 
 from jotfiles.model import Task
 from jotfiles.scrum import ScrumBoard, Sprint
+from jotfiles.state import JsonState
 
 logger = logging.getLogger(__name__)
 default_path = Path("credentials_jira.json")
 date_format = "%d/%b/%y %I:%M %p"
+jql_date_format = "%Y/%m/%d %H:%M"
+# JQL dates have minute precision, so incremental queries look a bit further back
+# than the last sync
+watermark_skew = timedelta(minutes=5)
+# create_task only reads these, so there is no point in downloading whole issues
+task_fields = ["summary", "aggregatetimeestimate"]
+search_page_size = 100
 
 
 @dataclass
@@ -66,12 +76,33 @@ def load_from_cli() -> Config:
     )
 
 
+def _utc(value: str) -> datetime:
+    # watermarks of older versions were stored in local time, without an offset
+    return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+
 class JiraScrumBoard(ScrumBoard):
-    def __init__(self, config: Config):
+    def __init__(
+        self,
+        config: Config,
+        watermarks: Optional[JsonState] = None,
+        reconcile_every: timedelta = timedelta(days=1),
+        max_workers: int = 4,
+    ):
         self.server_url = config.server_url
         self.owner = config.owner
         self.server = JIRA(str(self.server_url), auth=(self.owner, config.password))
         self.board = config.board
+        # board/assignee -> last successful sync, used by updated_sprint_tasks
+        self.watermarks = watermarks
+        self.reconcile_every = reconcile_every
+        # board -> active sprint, kept until the sprint ends or is invalidated
+        self._sprints: Dict[int, Sprint] = {}
+        # board:assignee -> watermark of listings not yet confirmed by the caller
+        self._pending: Dict[str, Dict[str, str]] = {}
+        self.max_workers = max_workers
+        # JQL dates are evaluated in the timezone of the JIRA user
+        self._timezone: Optional[tzinfo] = None
 
     def create_task(self, issue: Issue, due_date: datetime):
         return Task(
@@ -83,21 +114,155 @@ def create_task(self, issue: Issue, due_date: datetime):
         )
 
     def current_sprint(self) -> Sprint:
-        sprints = self.server.sprints(self.board)
+        return self._active_sprint(self.board)
+
+    def invalidate_sprint(self):
+        logger.debug("Dropping %s cached sprints", len(self._sprints))
+        self._sprints.clear()
+
+    def _active_sprint(self, board: int) -> Sprint:
+        sprint = self._sprints.get(board)
+        if sprint is None or sprint.end_date <= datetime.now():
+            sprint = self._fetch_active_sprint(board)
+            self._sprints[board] = sprint
+        return sprint
+
+    def _fetch_active_sprint(self, board: int) -> Sprint:
+        # the state filter is ignored by the legacy greenhopper API, hence the check
+        sprints = self.server.sprints(board, state="active")
         logger.debug("Searching for an active sprint in %s sprints", len(sprints))
-        summary = next(sprint for sprint in sprints if sprint.state == "ACTIVE")
-        jira_sprint = self.server.sprint_info(self.board, summary.id)
+        summary = next(
+            (sprint for sprint in sprints if sprint.state.upper() == "ACTIVE"), None
+        )
+        if summary is None:
+            # between sprints, until the next one is started
+            raise LookupError(f"No active sprint in board {board}")
+        jira_sprint = self.server.sprint_info(board, summary.id)
         end_date = datetime.strptime(jira_sprint["endDate"], date_format)
         return Sprint(jira_sprint["id"], end_date)
 
     def current_sprint_tasks(self, assignee: Optional[str] = None) -> List[Task]:
         assignee = assignee or self.owner
         sprint = self.current_sprint()
-        due_date = sprint.end_date
-        jql = "status !=  Closed AND Sprint = {} AND assignee in ({})".format(
-            sprint.id, assignee
+        jql = self._sprint_jql(sprint, assignee)
+        return list(self.search_tasks(jql, sprint.end_date))
+
+    def updated_sprint_tasks(self, assignee: Optional[str] = None) -> Iterator[Task]:
+        assignee = assignee or self.owner
+        sprint = self.current_sprint()
+        jql = self._sprint_jql(sprint, assignee)
+        if self.watermarks is None:
+            yield from self.search_tasks(jql, sprint.end_date)
+            return
+
+        key = f"{self.board}:{assignee}"
+        started = datetime.now(timezone.utc)
+        reconciled = started
+        full_sync = True
+
+        watermark = self.watermarks.get(key)
+        # a new sprint, or an old reconcile, requires listing every task again
+        if watermark and watermark["sprint"] == str(sprint.id):
+            last_reconcile = _utc(watermark["reconciled"])
+            if started - last_reconcile < self.reconcile_every:
+                since = _utc(watermark["updated"]) - watermark_skew
+                jira_since = since.astimezone(self._jira_timezone())
+                jql += f' AND updated >= "{jira_since.strftime(jql_date_format)}"'
+                reconciled = last_reconcile
+                full_sync = False
+                logger.debug("Searching tasks of %s updated since %s", assignee, since)
+        if full_sync:
+            logger.info("Reconciling all sprint tasks of %s", assignee)
+
+        yield from self.search_tasks(jql, sprint.end_date)
+        # the watermark only moves once the caller confirms the tasks were handled
+        self._pending[key] = {
+            "sprint": str(sprint.id),
+            "updated": started.isoformat(),
+            "reconciled": reconciled.isoformat(),
+        }
+
+    def _jira_timezone(self) -> tzinfo:
+        if self._timezone is None:
+            name = self.server.myself()["timeZone"]
+            self._timezone = tz.gettz(name)
+            if self._timezone is None:
+                logger.warning("Unknown JIRA timezone %s, using the local one", name)
+                self._timezone = tz.tzlocal()
+        return self._timezone
+
+    def commit_updates(self):
+        if self.watermarks is None:
+            return
+        while self._pending:
+            key, watermark = self._pending.popitem()
+            self.watermarks.put(key, watermark)
+
+    def sprint_task(self, key: str, assignee: Optional[str] = None) -> Optional[Task]:
+        sprint = self.current_sprint()
+        jql = f"key = {key} AND " + self._sprint_jql(sprint, assignee or self.owner)
+        return next(self.search_tasks(jql, sprint.end_date), None)
+
+    def team_sprint_tasks(
+        self, assignees: Iterable[str], boards: Optional[Iterable[int]] = None
+    ) -> Dict[str, List[Task]]:
+        assignees = list(assignees)
+        if not assignees:
+            return {}
+        boards = list(boards or [self.board])
+        tasks: Dict[str, List[Task]] = {assignee: [] for assignee in assignees}
+        workers = min(self.max_workers, len(boards))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(self._board_team_tasks, board, assignees)
+                for board in boards
+            ]
+            # JIRA may spell a name differently than the caller did
+            requested = {assignee.lower(): assignee for assignee in assignees}
+            for future in futures:
+                for assignee, task in future.result():
+                    key = requested.get(assignee.lower(), assignee)
+                    tasks.setdefault(key, []).append(task)
+        return tasks
+
+    def _board_team_tasks(
+        self, board: int, assignees: List[str]
+    ) -> List[Tuple[str, Task]]:
+        sprint = self._active_sprint(board)
+        # a single query per board, instead of one per assignee. Names are quoted,
+        # as a single one with reserved characters would break the whole query
+        names = ", ".join(
+            json.dumps(assignee, ensure_ascii=False) for assignee in assignees
         )
+        jql = self._sprint_jql(sprint, names)
+        logger.debug("Fetching sprint %s tasks of %s", sprint.id, assignees)
         return [
-            self.create_task(issue, due_date)
-            for issue in self.server.search_issues(jql)
+            (issue.fields.assignee.name, self.create_task(issue, sprint.end_date))
+            for issue in self._search_issues(jql, task_fields + ["assignee"])
         ]
+
+    def _sprint_jql(self, sprint: Sprint, assignee: str) -> str:
+        return "status !=  Closed AND Sprint = {} AND assignee in ({})".format(
+            sprint.id, assignee
+        )
+
+    def search_tasks(self, jql: str, due_date: datetime) -> Iterator[Task]:
+        for issue in self._search_issues(jql, task_fields):
+            yield self.create_task(issue, due_date)
+
+    def _search_issues(self, jql: str, fields: List[str]) -> Iterator[Issue]:
+        start = 0
+        while True:
+            page = self.server.search_issues(
+                jql,
+                startAt=start,
+                maxResults=search_page_size,
+                fields=fields,
+            )
+            logger.debug(
+                "Fetched issues %s-%s of %s", start, start + len(page), page.total
+            )
+            yield from page
+            start += len(page)
+            if not page or start >= page.total:
+                break
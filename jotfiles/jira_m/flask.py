@@ -20,15 +20,51 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-from flask import Blueprint
+import hmac
+import logging
+from dataclasses import asdict
 
-from jotfiles.jira_m import JiraScrumBoard, load_from_file
-from jotfiles.scrum import Sprint
+from flask import Blueprint, abort, current_app, jsonify, request
 
+from jotfiles.container import current_container
+
+logger = logging.getLogger(__name__)
 blueprint = Blueprint("jira", __name__, url_prefix="/jira")
 
+issue_events = {"jira:issue_created", "jira:issue_updated"}
+sprint_events = {"sprint_started", "sprint_updated", "sprint_closed"}
+
 
 @blueprint.route("/sprint")
-def current_sprint() -> Sprint:
-    config = load_from_file()
-    return JiraScrumBoard(config).current_sprint()
+def current_sprint():
+    return jsonify(asdict(current_container().scrum_board().current_sprint()))
+
+
+@blueprint.route("/webhook", methods=["POST"])
+def webhook():
+    # JIRA webhooks cannot sign requests, so the secret travels in the URL
+    secret = current_app.config.get("JIRA_WEBHOOK_SECRET")
+    if secret and not hmac.compare_digest(request.args.get("secret", ""), secret):
+        abort(403)
+
+    payload = request.get_json(force=True)
+    event = payload.get("webhookEvent")
+    logger.info("Received JIRA event %s", event)
+    if event not in issue_events and event not in sprint_events:
+        return "", 204
+
+    board = current_container().scrum_board()
+    p_space = current_container().personal_board()
+    if event in sprint_events:
+        board.invalidate_sprint()
+        # a closed sprint may not have a successor yet
+        if event == "sprint_started":
+            for task in board.updated_sprint_tasks():
+                p_space.upsert_task_card(task)
+            board.commit_updates()
+    else:
+        # the issue payload does not say if it belongs to the active sprint
+        task = board.sprint_task(payload["issue"]["key"])
+        if task is not None:
+            p_space.upsert_task_card(task)
+    return "", 204
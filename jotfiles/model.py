@@ -41,3 +41,4 @@ class CalendarEvent:
     name: str
     start: datetime
     duration: timedelta
+    cancelled: bool = False
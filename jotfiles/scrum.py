@@ -22,7 +22,7 @@
 
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional
 
 from jotfiles.model import Task
 
@@ -37,5 +37,21 @@ class ScrumBoard:
     def current_sprint(self) -> Sprint:
         pass
 
+    def invalidate_sprint(self):
+        pass
+
     def current_sprint_tasks(self, assignee: Optional[str] = None) -> List[Task]:
         pass
+
+    def updated_sprint_tasks(self, assignee: Optional[str] = None) -> Iterator[Task]:
+        # boards that cannot track changes fall back to a full listing
+        return iter(self.current_sprint_tasks(assignee))
+
+    def commit_updates(self):
+        pass
+
+    def team_sprint_tasks(
+        self, assignees: Iterable[str], boards: Optional[Iterable[int]] = None
+    ) -> Dict[str, List[Task]]:
+        # boards that cannot search others only list their own sprint
+        return {assignee: self.current_sprint_tasks(assignee) for assignee in assignees}
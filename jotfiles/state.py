@@ -0,0 +1,84 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+
+class JsonState:
+    """Small key-value document persisted to a JSON file on every write."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._data: Dict[str, Any] = {}
+        self._mtime: Optional[int] = None
+        self._reload()
+
+    def get(self, key: str, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            self._reload()
+            return self._data.get(key, default)
+
+    def put(self, key: str, value: Any):
+        with self._lock, self._file_lock():
+            self._reload(force=True)
+            self._data[key] = value
+            self._save()
+
+    def remove(self, key: str):
+        with self._lock, self._file_lock():
+            self._reload(force=True)
+            if self._data.pop(key, None) is not None:
+                self._save()
+
+    def _reload(self, force: bool = False):
+        # the poller and the flask app share the file, each writing its own keys
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return
+        if force or mtime != self._mtime:
+            with self.path.open() as f:
+                self._data = json.load(f)
+            self._mtime = mtime
+
+    @contextmanager
+    def _file_lock(self) -> Iterator[None]:
+        lock_path = self.path.with_suffix(self.path.suffix + ".lock")
+        with lock_path.open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            yield
+
+    def _save(self):
+        # write to a sibling file first, so a crash never leaves a truncated state
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        with tmp.open("w") as f:
+            json.dump(self._data, f, indent=2)
+        os.replace(tmp, self.path)
+        self._mtime = self.path.stat().st_mtime_ns
@@ -20,23 +20,85 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
+import hashlib
 import json
 import logging
+import re
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from datetime import datetime, timedelta
+from functools import partial
+from itertools import chain
 from pathlib import Path
-from typing import List
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from trello import Card, Label
+from trello import Card
 from trello import List as TList
 from trello import TrelloClient
 
-from jotfiles.components import PersonalBoard
-from jotfiles.comunication import ScheduledMessage, ScheduledMessagesPool
+from jotfiles.components import PersonalBoard, chunks, upsert_each
+from jotfiles.comunication import (
+    MessagesPoll,
+    ScheduledMessage,
+    ScheduledMessagesPool,
+    message_key,
+)
 from jotfiles.dates.formats import iso_8601
 from jotfiles.model import CalendarEvent, Task
+from jotfiles.trello_m.batch import TrelloBatch, batch_limit, route
+from jotfiles.trello_m.cache import BoardMetadata
+from jotfiles.trello_m.index import CardIndex, task_marker
+from jotfiles.trello_m.ratelimit import RateLimitedSession, limiter
+from jotfiles.trello_m.store import CardStore
 
 default_path = Path("credentials_trello.json")
 logger = logging.getLogger(__name__)
+# e.g. "send message to spaces/A thread spaces/A/threads/B at 2021-06-01 09:30: hi"
+message_query = "comment:send message is:open"
+message_format = re.compile(
+    r"send message to (?P<recipient>\S+)(?: thread (?P<thread>\S+))?"
+    r" at (?P<schedule>\d{4}-\d{2}-\d{2} \d{2}:\d{2}):(?P<content>.+)",
+    re.DOTALL,
+)
+message_date_format = "%Y-%m-%d %H:%M"
+comment_query = {"filter": "commentCard", "fields": "data"}
+search_limit = 1000
+# sprints last longer than this, so a task due this much earlier is from a closed one
+sprint_end_tolerance = timedelta(days=1)
+# cards synced this recently with the same fingerprint are not read again, a card
+# changed by hand is corrected by the first sync after that
+fingerprint_max_age = timedelta(days=1)
+# writes a sync makes to a card that is out of date
+task_card_writes = 3
+event_card_writes = 2
+# actions, as delivered by webhooks, that change the cached board metadata
+metadata_actions = {
+    "createList",
+    "updateList",
+    "createLabel",
+    "updateLabel",
+    "deleteLabel",
+    "createCustomField",
+    "updateCustomField",
+    "deleteCustomField",
+}
+# actions that add or remove open cards, or change their task and event fields
+card_actions = {
+    "createCard",
+    "copyCard",
+    "deleteCard",
+    "moveCardToBoard",
+    "moveCardFromBoard",
+    "updateCustomFieldItem",
+}
+# what the board reads from a card before syncing it
+card_state_query = {
+    "fields": "name,closed,due,dueComplete",
+    "attachments": "true",
+    "attachment_fields": "name,url",
+    "customFieldItems": "true",
+}
 
 
 @dataclass
@@ -46,7 +108,12 @@ class Config:
     board_id: str
 
     def create_client(self) -> TrelloClient:
-        return TrelloClient(api_key=self.api_key, token=self.token)
+        # a session keeps connections to trello alive between calls
+        return TrelloClient(
+            api_key=self.api_key,
+            token=self.token,
+            http_service=RateLimitedSession(limiter),
+        )
 
 
 def load_from_file(file: Path = default_path) -> Config:
@@ -58,47 +125,180 @@ def load_from_file(file: Path = default_path) -> Config:
 
 
 class TrelloScheduledMessagesPool(ScheduledMessagesPool):
-    def __init__(self, client: TrelloClient):
+    def __init__(
+        self, client: TrelloClient, board_ids: Iterable[str], max_workers: int = 4
+    ):
         self.client = client
+        self.batch = TrelloBatch(client)
+        self.board_ids = list(board_ids)
+        self.max_workers = max_workers
+        # keys of the messages returned by the last poll_messages
+        self._seen: Set[str] = set()
 
     def list_messages(self) -> List[ScheduledMessage]:
-        query = "comment:send message is:open"
-        messages = []
-        for card in self.client.search(query, models=["cards"]):
-            card: Card = card
-            messages.append(*card.comments)
-        return messages
+        return list(self._messages())
+
+    def poll_messages(self) -> MessagesPoll:
+        current = {message_key(message): message for message in self._messages()}
+        new = [message for key, message in current.items() if key not in self._seen]
+        # deleted comments are gone, edited ones come back with a new key
+        gone = self._seen - current.keys()
+        self._seen = set(current)
+        return MessagesPoll(new, gone)
+
+    def _messages(self) -> Iterator[ScheduledMessage]:
+        # a plain search, the client would also fetch the board of every card
+        found = self.client.fetch_json(
+            "/search",
+            query_params={
+                "query": message_query,
+                "modelTypes": "cards",
+                "idBoards": ",".join(self.board_ids),
+                "cards_limit": search_limit,
+                "card_fields": "id",
+            },
+        )
+        routes = [
+            route(f"/cards/{card['id']}/actions", comment_query)
+            for card in found["cards"]
+        ]
+        if not routes:
+            return
+        workers = min(self.max_workers, len(routes))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for comments in executor.map(self.batch.get, chunks(routes, batch_limit)):
+                for comment in chain.from_iterable(filter(None, comments)):
+                    message = _parse_message(comment)
+                    if message is not None:
+                        yield message
+
+
+def _parse_message(comment: Dict[str, Any]) -> Optional[ScheduledMessage]:
+    match = message_format.match(comment["data"]["text"])
+    if match is None:
+        logger.debug("Ignoring comment %s", comment["id"])
+        return None
+    try:
+        schedule = datetime.strptime(match["schedule"], message_date_format)
+    except ValueError:
+        logger.warning("Invalid schedule in comment %s", comment["id"])
+        return None
+    return ScheduledMessage(
+        match["content"].strip(),
+        match["recipient"],
+        match["thread"],
+        schedule,
+        comment["id"],
+    )
 
 
 def _bot_comment(message: str) -> str:
     return f"BOT {message}"
 
 
+def _fingerprint(*values: Any) -> str:
+    return hashlib.sha1("|".join(map(str, values)).encode()).hexdigest()
+
+
+def _field_values(state: Dict[str, Any]) -> Dict[str, Any]:
+    # custom field id -> value, e.g. {"number": "2.5"}
+    return {
+        item["idCustomField"]: item["value"]
+        for item in state.get("customFieldItems", [])
+    }
+
+
+def _timestamp(trello_date: str) -> float:
+    return datetime.fromisoformat(trello_date.replace("Z", "+00:00")).timestamp()
+
+
+def _same_instant(trello_date: Optional[str], date: datetime) -> bool:
+    if not trello_date:
+        return False
+    return _timestamp(trello_date) == date.timestamp()
+
+
+def _stale(
+    card: Dict[str, Any],
+    inactive_since: datetime,
+    sprint_end: Optional[datetime],
+    task_field: str,
+) -> bool:
+    if _timestamp(card["dateLastActivity"]) < inactive_since.timestamp():
+        return True
+    # task cards are due at the end of their sprint, other cards say nothing about it
+    due = card["due"]
+    if not sprint_end or not due or task_field not in _field_values(card):
+        return False
+    # older cards were written without their utc offset, and may be hours off
+    return _timestamp(due) < (sprint_end - sprint_end_tolerance).timestamp()
+
+
 class TrelloPersonalBoard(PersonalBoard):
-    def __init__(self, client: TrelloClient, board_id: str):
+    def __init__(
+        self,
+        client: TrelloClient,
+        board_id: str,
+        store: Optional[CardStore] = None,
+        max_workers: int = 4,
+    ):
         self.client = client
+        self.max_workers = max_workers
+        # done cards already set due complete, so later changes are left alone
+        self._done_cards: Set[str] = set()
+        self.batch = TrelloBatch(client)
+        self.store = store
+        # trello write calls made and avoided, since the last pop_write_stats
+        self.write_stats = Counter(written=0, skipped=0)
         self.board = self.client.get_board(board_id)
-        # name to id map
-        self.trello_lists = {tl.name: tl.id for tl in self.board.all_lists()}
-        # cache labels
-        self.labels = self.board.get_labels()
-        self.custom_fields = {
-            cf.name: cf for cf in self.board.get_custom_field_definitions()
-        }
+        self.metadata = BoardMetadata(self.board)
+        self.index = CardIndex(
+            self.board,
+            self.metadata.custom_field("Task").id,
+            self.metadata.custom_field("CalendarId").id,
+        )
 
     def create_review_card(self, name, desc):
         pass
         # today_team.add_card(name, desc, [support_review])
 
-    def _search_open_cards(self, query: str) -> List[Card]:
-        return self.client.search(
-            f"{query} is:open", models=["cards"], board_ids=[self.board.id]
-        )
-
     def upsert_task_card(self, task: Task):
+        self._upsert_task_card(task, {})
+
+    def upsert_task_cards(self, tasks: Iterable[Task]) -> Dict[str, Optional[str]]:
+        report = {}
+        for chunk in chunks(tasks, batch_limit):
+            # the state of every candidate card is read upfront, in one batch
+            try:
+                states = self._card_states(
+                    card_id
+                    for task in chunk
+                    if not self._in_sync(
+                        f"task:{task.id}", self._task_fingerprint(task)
+                    )
+                    for card_id in self._candidates(
+                        f"task:{task.id}", partial(self.index.task_cards, task.id)
+                    )
+                )
+            except Exception as e:
+                logger.exception("Failed to read the cards of %s tasks", len(chunk))
+                report.update({task.id: str(e) for task in chunk})
+                continue
+            upsert = partial(self._upsert_task_card, states=states)
+            report.update(upsert_each(upsert, chunk, lambda task: task.id))
+        return report
+
+    def _upsert_task_card(self, task: Task, states: Dict[str, Optional[Dict]]):
         key = task.id
-        task_comment = f"task_id_{key}"
-        cards2update = self._search_open_cards(f"comment:{task_comment}")
+        store_key = f"task:{key}"
+        fingerprint = self._task_fingerprint(task)
+        if self._in_sync(store_key, fingerprint):
+            self.write_stats["skipped"] += task_card_writes
+            return
+        task_comment = f"{task_marker}{key}"
+        cards2update = self._lookup(
+            store_key, partial(self.index.task_cards, key), states
+        )
         if len(cards2update) > 1:
             logger.warning(
                 "Multiple cards exist for task %s. Consider breaking the "
@@ -108,70 +308,299 @@ def upsert_task_card(self, task: Task):
         elif len(cards2update) == 0:
             backlog = self._backlog()
             logger.debug("Adding card to the list")
-            ls = [self._label("task:sprint")]
-            due = task.due_date.strftime(iso_8601)
+            ls = [self.metadata.label("task:sprint")]
+            due = task.due_date.astimezone().strftime(iso_8601)
             card = backlog.add_card(task.title, position=0, labels=ls, due=due)
             logger.debug("Setting custom task field")
-            card.set_custom_field(key, self.custom_fields["Task"])
+            card.set_custom_field(key, self.metadata.custom_field("Task"))
             card.comment(task_comment)
-            cards2update = [card]
-        for card in cards2update:
+            self.index.add_task_card(key, card)
+            cards2update = [(card, {"attachments": []})]
+        self._remember(store_key, cards2update)
+        for card, state in cards2update:
             logger.debug("Syncing card %s with task %s", card.name, key)
-            self._update_task_card(card, task)
+            self._update_task_card(card, task, state)
+            self._synced(store_key, fingerprint)
+
+    def _update_task_card(self, card: Card, task: Task, state: Dict[str, Any]):
+        time_field = self.metadata.custom_field("Time (h)")
+        current = _field_values(state).get(time_field.id, {}).get("number")
+        if current is not None and float(current) == self._remaining(task):
+            self.write_stats["skipped"] += 1
+        else:
+            self._update_remaining(task, card)
+            self.write_stats["written"] += 1
 
-    def _update_task_card(self, card: Card, task: Task):
-        self._update_remaining(task, card)
         url_str = str(task.url)
-        task_attachments = [att for att in card.attachments if att.url == url_str]
+        task_attachments = [
+            att for att in state["attachments"] if att["url"] == url_str
+        ]
+        if len(task_attachments) == 1:
+            # removing and attaching it again
+            self.write_stats["skipped"] += 2
+            return
         for att in task_attachments:
-            logger.debug("Removing attachment %s", att.name)
-            card.remove_attachment(att.id)
+            logger.debug("Removing attachment %s", att["name"])
+            card.remove_attachment(att["id"])
         card.attach("Task URL", url=url_str)
+        self.write_stats["written"] += len(task_attachments) + 1
 
     def upsert_calendar_card(self, event: CalendarEvent):
+        self._upsert_calendar_card(event, {})
+
+    def upsert_calendar_cards(
+        self, events: Iterable[CalendarEvent]
+    ) -> Dict[str, Optional[str]]:
+        report = {}
+        for chunk in chunks(events, batch_limit):
+            try:
+                states = self._card_states(
+                    card_id
+                    for event in chunk
+                    if not self._in_sync(
+                        f"event:{event.id}", self._event_fingerprint(event)
+                    )
+                    for card_id in self._candidates(
+                        f"event:{event.id}",
+                        partial(self.index.event_cards, event.id),
+                    )
+                )
+            except Exception as e:
+                logger.exception("Failed to read the cards of %s events", len(chunk))
+                report.update({event.id: str(e) for event in chunk})
+                continue
+            upsert = partial(self._upsert_calendar_card, states=states)
+            report.update(upsert_each(upsert, chunk, lambda event: event.id))
+        return report
+
+    def _upsert_calendar_card(
+        self, event: CalendarEvent, states: Dict[str, Optional[Dict]]
+    ):
         event_id = event.id
-        cards2update = self._search_open_cards(event_id)
+        store_key = f"event:{event_id}"
+        fingerprint = self._event_fingerprint(event)
+        if self._in_sync(store_key, fingerprint):
+            self.write_stats["skipped"] += event_card_writes
+            return
+        cards2update = self._lookup(
+            store_key, partial(self.index.event_cards, event_id), states
+        )
         if len(cards2update) > 1:
             # TODO Instead of generating an exception, simply create a card to fix
             #  the other cards
             raise ValueError(
-                f"Multiple cards associated with the same event {cards2update}"
+                "Multiple cards associated with the same event "
+                f"{[card for card, _ in cards2update]}"
             )
         elif len(cards2update) == 0:
             backlog = self._backlog()
             logger.debug("Adding card to the list")
-            card = backlog.add_card(event.name, source=self._template("Meeting"))
-            cards2update = [card]
-        for card in cards2update:
-            self._update_calendar_card(card, event)
+            template = self.metadata.template_id("Meeting")
+            card = backlog.add_card(event.name, source=template)
+            self.index.add_event_card(event_id, card)
+            cards2update = [(card, {})]
+        self._remember(store_key, cards2update)
+        for card, state in cards2update:
+            self._update_calendar_card(card, event, state)
+            self._synced(store_key, fingerprint)
+
+    def archive_calendar_card(self, event: CalendarEvent):
+        store_key = f"event:{event.id}"
+        cards = self._lookup(store_key, partial(self.index.event_cards, event.id), {})
+        for card, state in cards:
+            self._archive({"id": card.id, "name": state["name"]})
+            self.write_stats["written"] += 1
+        if self.store is not None:
+            self.store.forget(store_key)
+        if cards:
+            self.index.invalidate()
+
+    def _update_calendar_card(
+        self, card: Card, event: CalendarEvent, state: Dict[str, Any]
+    ):
+        if _same_instant(state.get("due"), event.start):
+            self.write_stats["skipped"] += 1
+        else:
+            logger.debug("Setting due date")
+            card.set_due(event.start)
+            self.write_stats["written"] += 1
+
+        event_field = self.metadata.custom_field("CalendarId")
+        if _field_values(state).get(event_field.id, {}).get("text") == event.id:
+            self.write_stats["skipped"] += 1
+        else:
+            logger.debug("Setting custom task field")
+            card.set_custom_field(event.id, event_field)
+            self.write_stats["written"] += 1
+
+    def pop_write_stats(self) -> Dict[str, int]:
+        stats = dict(self.write_stats)
+        self.write_stats.subtract(stats)
+        return stats
+
+    def _candidates(
+        self, store_key: str, indexed: Callable[[], List[Card]]
+    ) -> List[str]:
+        if self.store is not None:
+            card_id = self.store.card_id(store_key)
+            if card_id is not None:
+                return [card_id]
+        return [card.id for card in indexed()]
+
+    def _lookup(
+        self,
+        store_key: str,
+        indexed: Callable[[], List[Card]],
+        states: Dict[str, Optional[Dict]],
+    ) -> List[Tuple[Card, Dict[str, Any]]]:
+        # the local store is checked first, and trusted as long as its card is open
+        if self.store is not None:
+            card_id = self.store.card_id(store_key)
+            if card_id is not None:
+                state = self._card_state(card_id, states)
+                if state is not None:
+                    return [(Card(self.board, card_id, state["name"]), state)]
+                logger.debug("Card %s of %s is gone", card_id, store_key)
+                self.store.forget(store_key)
+        cards = []
+        for card in indexed():
+            state = self._card_state(card.id, states)
+            if state is not None:
+                cards.append((card, state))
+        return cards
+
+    def _card_state(
+        self, card_id: str, states: Dict[str, Optional[Dict]]
+    ) -> Optional[Dict[str, Any]]:
+        if card_id not in states:
+            states.update(self._card_states([card_id]))
+        return states[card_id]
+
+    def _card_states(self, card_ids: Iterable[str]) -> Dict[str, Optional[Dict]]:
+        # card id -> state, None if the card is missing or archived
+        card_ids = list(dict.fromkeys(card_ids))
+        routes = [route(f"/cards/{card_id}", card_state_query) for card_id in card_ids]
+        return {
+            card_id: state if state and not state["closed"] else None
+            for card_id, state in zip(card_ids, self.batch.get(routes))
+        }
+
+    def _remember(self, store_key: str, cards: List[Tuple[Card, Dict[str, Any]]]):
+        # ambiguous mappings are left for the index to resolve
+        if self.store is not None and len(cards) == 1:
+            self.store.put(store_key, cards[0][0].id)
+
+    def _in_sync(self, store_key: str, fingerprint: str) -> bool:
+        if self.store is None:
+            return False
+        synced_since = datetime.now() - fingerprint_max_age
+        return self.store.fingerprint(store_key, synced_since) == fingerprint
 
-    def _update_calendar_card(self, card: Card, event: CalendarEvent):
-        logger.debug("Setting due date")
-        card.set_due(event.start.strftime(iso_8601))
-        logger.debug("Setting custom task field")
-        card.set_custom_field(event.id, self.custom_fields["CalendarId"])
+    def _task_fingerprint(self, task: Task) -> str:
+        return _fingerprint(self._remaining(task), task.url)
+
+    @staticmethod
+    def _event_fingerprint(event: CalendarEvent) -> str:
+        return _fingerprint(event.start.isoformat(), event.id)
+
+    def _synced(self, store_key: str, fingerprint: str):
+        if self.store is not None:
+            self.store.mark_synced(store_key, fingerprint)
 
     def _update_remaining(self, task: Task, card: Card):
         logger.debug("Setting custom remaining field")
-        remaining_sec = str(task.remaining.total_seconds() / 3600)
-        card.set_custom_field(remaining_sec, self.custom_fields["Time (h)"])
+        remaining_sec = str(self._remaining(task))
+        card.set_custom_field(remaining_sec, self.metadata.custom_field("Time (h)"))
+
+    @staticmethod
+    def _remaining(task: Task) -> float:
+        return task.remaining.total_seconds() / 3600
+
+    def register_webhook(self, callback_url: str) -> bool:
+        hook = self.client.create_hook(callback_url, self.board.id, desc="jotfiles")
+        # trello refuses a second hook with the same callback, model and token
+        return bool(hook)
+
+    def handle_action(self, action: Dict[str, Any]):
+        kind = action["type"]
+        data = action.get("data", {})
+        logger.debug("Handling trello action %s", kind)
+        if kind in metadata_actions or data.get("list", {}).get("name") == "Templates":
+            self.metadata.invalidate()
+        if kind in card_actions or "closed" in data.get("old", {}):
+            self.index.invalidate()
+        elif kind == "commentCard" and task_marker in data.get("text", ""):
+            self.index.invalidate()
+        moved_to = data.get("listAfter", {}).get("id")
+        if kind == "updateCard" and moved_to == self.metadata.list_id("Done"):
+            card = self.client.fetch_json(
+                f"/cards/{data['card']['id']}",
+                query_params={"fields": "name,due,dueComplete"},
+            )
+            if card["due"] and not card["dueComplete"]:
+                self._complete(card)
 
     def update_done(self):
         logger.info("Fetching done cards")
-        done_list = self.board.get_list(self.trello_lists["Done"])
-        for card in done_list.list_cards():
-            if card.due_date:
-                logger.debug("Setting card %s due complete", card.name)
-                card.set_due_complete()
-        logger.info("Update complete")
+        done_cards = self.client.fetch_json(
+            f"/lists/{self.metadata.list_id('Done')}/cards",
+            query_params={"fields": "name,due,dueComplete"},
+        )
+        # cards that left the list no longer need to be remembered
+        self._done_cards &= {card["id"] for card in done_cards}
+        pending = [
+            card
+            for card in done_cards
+            if card["due"]
+            and not card["dueComplete"]
+            and card["id"] not in self._done_cards
+        ]
+        if pending:
+            workers = min(self.max_workers, len(pending))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self._complete, pending))
+        logger.info("Update complete, %s cards set due complete", len(pending))
 
-    def _backlog(self) -> TList:
-        logger.debug("Fetching backlog list")
-        return self.board.get_list(self.trello_lists["[Backlog] On Hold"])
+    def archive_done(self, max_age: timedelta, sprint_end: Optional[datetime] = None):
+        logger.info("Fetching done cards to archive")
+        done_cards = self.client.fetch_json(
+            f"/lists/{self.metadata.list_id('Done')}/cards",
+            query_params={
+                "fields": "name,due,dateLastActivity",
+                "customFieldItems": "true",
+            },
+        )
+        inactive_since = datetime.now() - max_age
+        task_field = self.metadata.custom_field("Task").id
+        stale = [
+            card
+            for card in done_cards
+            if _stale(card, inactive_since, sprint_end, task_field)
+        ]
+        if stale:
+            workers = min(self.max_workers, len(stale))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(self._archive, stale))
+            self.index.invalidate()
+        logger.info("Archived %s of %s done cards", len(stale), len(done_cards))
+
+    def _archive(self, card: Dict[str, Any]):
+        logger.debug("Archiving card %s", card["name"])
+        self.client.fetch_json(
+            f"/cards/{card['id']}", http_method="PUT", query_params={"closed": "true"}
+        )
+        self._done_cards.discard(card["id"])
 
-    def _template(self, name: str) -> Card:
-        # TODO search card by name and list
-        return self._search_open_cards(f"list:Templates {name}")[0]
+    def _complete(self, card: Dict[str, Any]):
+        logger.debug("Setting card %s due complete", card["name"])
+        self.client.fetch_json(
+            f"/cards/{card['id']}",
+            http_method="PUT",
+            query_params={"dueComplete": "true"},
+        )
+        self._done_cards.add(card["id"])
 
-    def _label(self, name: str) -> Label:
-        return next(label for label in self.labels if label.name == name)
+    def _backlog(self) -> TList:
+        # cards are added by id, so the list itself needs no fetch
+        name = "[Backlog] On Hold"
+        return TList(self.board, self.metadata.list_id(name), name)
@@ -0,0 +1,64 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import logging
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import urlencode
+
+from trello import TrelloClient
+
+from jotfiles.components import chunks
+
+logger = logging.getLogger(__name__)
+# maximum number of routes trello accepts in a single batch call
+batch_limit = 10
+
+
+def route(path: str, query: Optional[Dict[str, str]] = None) -> str:
+    # commas separate routes, so the ones within a route must be escaped
+    return f"{path}?{urlencode(query)}" if query else path
+
+
+class TrelloBatch:
+    """Groups GET requests into calls to trello's /batch endpoint."""
+
+    def __init__(self, client: TrelloClient):
+        self.client = client
+
+    def get(self, routes: Sequence[str]) -> List[Optional[Any]]:
+        # one result per route, None for the ones that do not exist
+        results = []
+        for chunk in chunks(routes, batch_limit):
+            responses = self.client.fetch_json(
+                "/batch", query_params={"urls": ",".join(chunk)}
+            )
+            for path, response in zip(chunk, responses):
+                if "200" in response:
+                    results.append(response["200"])
+                elif "404" in response or response.get("statusCode") == 404:
+                    logger.debug("Batched request %s not found", path)
+                    results.append(None)
+                else:
+                    # throttled or failed requests say nothing about the resource
+                    raise RuntimeError(f"Batched request {path} failed: {response}")
+        return results
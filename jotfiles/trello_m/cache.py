@@ -0,0 +1,102 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional
+
+from trello import Board, CustomFieldDefinition, Label
+
+logger = logging.getLogger(__name__)
+templates_list = "Templates"
+# a name missing from a fresh cache is a typo, not a rename
+min_refresh_interval = timedelta(minutes=1)
+# the most labels trello returns in a single request
+label_limit = 1000
+
+
+class BoardMetadata:
+    """Lists, labels, custom fields and template cards of a board, by name."""
+
+    def __init__(self, board: Board, max_age: timedelta = timedelta(hours=1)):
+        self.board = board
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._loaded_at: Optional[datetime] = None
+        self._lists: Dict[str, str] = {}
+        self._labels: Dict[str, Label] = {}
+        self._custom_fields: Dict[str, CustomFieldDefinition] = {}
+        self._templates: Dict[str, str] = {}
+
+    def list_id(self, name: str) -> str:
+        return self._lookup("_lists", name)
+
+    def label(self, name: str) -> Label:
+        return self._lookup("_labels", name)
+
+    def custom_field(self, name: str) -> CustomFieldDefinition:
+        return self._lookup("_custom_fields", name)
+
+    def template_id(self, name: str) -> str:
+        return self._lookup("_templates", name)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def load(self):
+        with self._lock:
+            logger.debug("Loading metadata of board %s", self.board.id)
+            self._lists = {tl.name: tl.id for tl in self.board.all_lists()}
+            labels = self.board.get_labels(limit=label_limit)
+            self._labels = {label.name: label for label in labels}
+            # the board keeps the first definitions it fetched, so they are read
+            # here, and handed to the board as it parses the fields of its cards
+            definitions = CustomFieldDefinition.from_json_list(
+                self.board,
+                self.board.client.fetch_json(f"/boards/{self.board.id}/customFields"),
+            )
+            self.board.customFieldDefinitions = definitions
+            self._custom_fields = {cf.name: cf for cf in definitions}
+            self._templates = {}
+            if templates_list in self._lists:
+                cards = self.board.client.fetch_json(
+                    f"/lists/{self._lists[templates_list]}/cards",
+                    query_params={"fields": "name"},
+                )
+                self._templates = {card["name"]: card["id"] for card in cards}
+            self._loaded_at = datetime.now()
+
+    def _lookup(self, section: str, name: str) -> Any:
+        with self._lock:
+            if self._loaded_at is None or self._age() > self.max_age:
+                self.load()
+            values = getattr(self, section)
+            if name not in values and self._age() > min_refresh_interval:
+                # the name may have been created or renamed since the last load
+                self.load()
+                values = getattr(self, section)
+            return values[name]
+
+    def _age(self) -> timedelta:
+        return datetime.now() - self._loaded_at
@@ -20,22 +20,99 @@
 #  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #  SOFTWARE.
 
-from flask import Blueprint, request
+import base64
+import hashlib
+import hmac
+import json
+from datetime import datetime, timedelta
+from typing import Any, Dict
+
+from flask import Blueprint, abort, current_app, jsonify, request
+from furl import furl
 
 import jotfiles.jira_m
+from jotfiles.container import current_container
 from jotfiles.model import Task
+from jotfiles.trello_m.ratelimit import limiter
 
 blueprint = Blueprint("trello", __name__, url_prefix="/trello")
 
 
+def _parse_task(raw: Dict[str, Any]) -> Task:
+    return Task(
+        str(raw["id"]),
+        str(raw["title"]),
+        timedelta(seconds=float(raw["remaining"])),
+        datetime.fromisoformat(raw["due_date"]),
+        furl(raw["url"]),
+    )
+
+
 @blueprint.route("/task", methods=["PUT"])
 def upsert_task_card():
 
-    from jotfiles.trello_m import TrelloPersonalBoard, load_from_file
-
     if request.method == "PUT":
-        task: Task = request.args.get("task")
-        config = load_from_file()
+        try:
+            task = _parse_task(json.loads(request.args["task"]))
+        except (KeyError, TypeError, ValueError) as e:
+            abort(400, f"Invalid task: {e}")
         jotfiles.jira_m.logger.info("Upserting task %s", task)
-        client = TrelloPersonalBoard(config.create_client(), config.board_id)
-        client.upsert_task_card(task)
+        current_container().personal_board().upsert_task_card(task)
+        return "", 204
+
+
+@blueprint.route("/tasks", methods=["PUT"])
+def upsert_task_cards():
+    raw_tasks = request.get_json(force=True)
+    if not isinstance(raw_tasks, list):
+        abort(400, "Expected a list of tasks")
+
+    # parsed task, or the result of an invalid entry, in the order received
+    entries = []
+    for raw in raw_tasks:
+        try:
+            entries.append((_parse_task(raw), None))
+        except (KeyError, TypeError, ValueError) as e:
+            task_id = raw.get("id") if isinstance(raw, dict) else None
+            entries.append(
+                (None, {"id": task_id, "status": "invalid", "error": str(e)})
+            )
+
+    # a single board instance serves the whole batch
+    tasks = [task for task, _ in entries if task is not None]
+    report = current_container().personal_board().upsert_task_cards(tasks)
+    results = []
+    for task, invalid in entries:
+        if task is None:
+            results.append(invalid)
+            continue
+        error = report[task.id]
+        status = "upserted" if error is None else "failed"
+        results.append({"id": task.id, "status": status, "error": error})
+    return jsonify(results)
+
+
+@blueprint.route("/ratelimit", methods=["GET"])
+def rate_limit_stats():
+    return jsonify(limiter.stats())
+
+
+@blueprint.route("/webhook", methods=["HEAD", "POST"])
+def webhook():
+    # trello checks the callback answers before creating the webhook
+    if request.method == "HEAD":
+        return "", 200
+
+    secret = current_app.config.get("TRELLO_WEBHOOK_SECRET")
+    if secret:
+        callback_url = current_app.config.get("TRELLO_WEBHOOK_URL") or request.url
+        content = request.get_data() + callback_url.encode()
+        digest = hmac.new(secret.encode(), content, hashlib.sha1).digest()
+        expected = base64.b64encode(digest).decode()
+        signature = request.headers.get("X-Trello-Webhook", "")
+        if not hmac.compare_digest(signature, expected):
+            abort(403)
+
+    action = request.get_json(force=True)["action"]
+    current_container().personal_board().handle_action(action)
+    return "", 200
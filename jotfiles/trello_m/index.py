@@ -0,0 +1,131 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import logging
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from trello import Board, Card
+
+logger = logging.getLogger(__name__)
+task_marker = "task_id_"
+actions_page_size = 1000
+
+
+class CardIndex:
+    """
+    Open cards of a board, indexed by the task and calendar event they track.
+
+    Cards are loaded in bulk and reloaded once the index is older than max_age,
+    while cards created by us are added as they are created.
+    """
+
+    def __init__(
+        self,
+        board: Board,
+        task_field_id: str,
+        event_field_id: str,
+        max_age: timedelta = timedelta(minutes=15),
+    ):
+        self.board = board
+        self.task_field_id = task_field_id
+        self.event_field_id = event_field_id
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._loaded_at: Optional[datetime] = None
+        # card id -> task id, from task_id_* comments. Reloads only fetch the
+        # comments posted since the previous load
+        self._markers: Dict[str, str] = {}
+        self._last_comment: Optional[str] = None
+        self._tasks: Dict[str, List[Card]] = defaultdict(list)
+        self._events: Dict[str, List[Card]] = defaultdict(list)
+
+    def task_cards(self, task_id: str) -> List[Card]:
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._tasks.get(task_id, []))
+
+    def event_cards(self, event_id: str) -> List[Card]:
+        with self._lock:
+            self._ensure_loaded()
+            return list(self._events.get(event_id, []))
+
+    def add_task_card(self, task_id: str, card: Card):
+        with self._lock:
+            self._tasks[task_id].append(card)
+
+    def add_event_card(self, event_id: str, card: Card):
+        with self._lock:
+            self._events[event_id].append(card)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or datetime.now() - self._loaded_at > self.max_age:
+            self.load()
+
+    def load(self):
+        with self._lock:
+            logger.debug("Indexing open cards of board %s", self.board.id)
+            self._load_markers()
+            tasks = defaultdict(list)
+            events = defaultdict(list)
+            for card in self.board.open_cards():
+                fields = {cf.definition_id: cf.value for cf in card.customFields}
+                task_ids = {fields.get(self.task_field_id), self._markers.get(card.id)}
+                for task_id in task_ids - {None, ""}:
+                    tasks[task_id].append(card)
+                event_id = fields.get(self.event_field_id)
+                if event_id:
+                    events[event_id].append(card)
+            self._tasks = tasks
+            self._events = events
+            self._loaded_at = datetime.now()
+            logger.debug("Indexed %s tasks and %s events", len(tasks), len(events))
+
+    def _load_markers(self):
+        query = {"filter": "commentCard", "fields": "data", "limit": actions_page_size}
+        if self._last_comment:
+            query["since"] = self._last_comment
+        newest = None
+        while True:
+            actions = self.board.client.fetch_json(
+                f"/boards/{self.board.id}/actions", query_params=query
+            )
+            # actions come newest first
+            if actions and newest is None:
+                newest = actions[0]["id"]
+            for action in actions:
+                text = action["data"].get("text", "")
+                if text.startswith(task_marker):
+                    card_id = action["data"]["card"]["id"]
+                    self._markers[card_id] = text[len(task_marker) :].strip()
+            if len(actions) < actions_page_size:
+                break
+            query["before"] = actions[-1]["id"]
+        if newest is not None:
+            self._last_comment = newest
@@ -0,0 +1,128 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+from jotfiles.http import retry_after
+
+logger = logging.getLogger(__name__)
+# trello allows 100 requests per 10 seconds for each token, and the first 10
+# seconds may send a full burst on top of the rate
+default_rate = 8.0
+default_burst = 15
+min_rate = 0.5
+max_retries = 5
+
+
+class RateLimiter:
+    """Token bucket whose rate backs off when trello starts throttling."""
+
+    def __init__(self, rate: float = default_rate, burst: int = default_burst):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        # nobody sends requests before this instant, set by Retry-After
+        self._blocked_until = self._updated
+        self._lock = threading.Lock()
+        self.throttled_seconds = 0.0
+        self.throttled_requests = 0
+        self.rejected_requests = 0
+        self._rejections = 0
+
+    def acquire(self):
+        throttled = False
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0 and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(wait, (1 - self._tokens) / self.rate)
+                self.throttled_seconds += wait
+                if not throttled:
+                    self.throttled_requests += 1
+                    throttled = True
+            time.sleep(wait)
+
+    def succeeded(self):
+        with self._lock:
+            self._rejections = 0
+            # additive increase back towards the configured rate
+            self.rate = min(self.max_rate, self.rate + 0.1)
+
+    def rejected(self, retry_after: Optional[float]):
+        with self._lock:
+            self.rejected_requests += 1
+            self._rejections += 1
+            self.rate = max(min_rate, self.rate / 2)
+            delay = retry_after
+            if delay is None:
+                delay = float(2**self._rejections)
+            self._tokens = 0
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            logger.warning(
+                "Throttled by trello, waiting %.1fs at %.1f req/s", delay, self.rate
+            )
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "throttled_seconds": self.throttled_seconds,
+                "throttled_requests": self.throttled_requests,
+                "rejected_requests": self.rejected_requests,
+            }
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class RateLimitedSession(requests.Session):
+    """Session that sends every request through a shared rate limiter."""
+
+    def __init__(self, limiter: RateLimiter):
+        super().__init__()
+        self.limiter = limiter
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        for _ in range(max_retries):
+            self.limiter.acquire()
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code != 429:
+                self.limiter.succeeded()
+                return response
+            self.limiter.rejected(retry_after(response))
+        return response
+
+
+# trello limits each token, so every client in the process shares one bucket
+limiter = RateLimiter()
@@ -0,0 +1,98 @@
+#  MIT License
+#
+#  Copyright (c) 2021 João Sousa
+#
+#  Permission is hereby granted, free of charge, to any person obtaining a copy
+#  of this software and associated documentation files (the "Software"), to deal
+#  in the Software without restriction, including without limitation the rights
+#  to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#  copies of the Software, and to permit persons to whom the Software is
+#  furnished to do so, subject to the following conditions:
+#
+#  The above copyright notice and this permission notice shall be included in all
+#  copies or substantial portions of the Software.
+#
+#  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#  IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#  FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#  AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#  LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#  OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#  SOFTWARE.
+
+
+import sqlite3
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+
+class CardStore:
+    """
+    Local record of which card tracks each task or calendar event.
+
+    Keys are namespaced by kind, e.g. ``task:PRJ-1`` or ``event:<id>``. Entries
+    are only hints: the board drops them as soon as their card is found to be
+    missing or archived.
+    """
+
+    def __init__(self, path: Path):
+        # connections are shared by the flask request threads
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cards ("
+                " key TEXT PRIMARY KEY,"
+                " card_id TEXT NOT NULL,"
+                " fingerprint TEXT,"
+                " created_at TEXT NOT NULL,"
+                " synced_at TEXT"
+                ")"
+            )
+
+    def card_id(self, key: str) -> Optional[str]:
+        row = self._fetch("SELECT card_id FROM cards WHERE key = ?", key)
+        return row[0] if row else None
+
+    def fingerprint(self, key: str, synced_since: datetime) -> Optional[str]:
+        row = self._fetch(
+            "SELECT fingerprint FROM cards WHERE key = ? AND synced_at >= ?",
+            key,
+            synced_since.isoformat(),
+        )
+        return row[0] if row else None
+
+    def put(self, key: str, card_id: str):
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO cards (key, card_id, created_at) "
+                "VALUES (?, ?, ?)",
+                (key, card_id, datetime.now().isoformat()),
+            )
+            # a different card invalidates whatever was synced to the previous one
+            self._conn.execute(
+                "UPDATE cards SET card_id = ?, fingerprint = NULL, synced_at = NULL "
+                "WHERE key = ? AND card_id != ?",
+                (card_id, key, card_id),
+            )
+
+    def mark_synced(self, key: str, fingerprint: Optional[str] = None):
+        self._execute(
+            "UPDATE cards SET fingerprint = ?, synced_at = ? WHERE key = ?",
+            fingerprint,
+            datetime.now().isoformat(),
+            key,
+        )
+
+    def forget(self, key: str):
+        self._execute("DELETE FROM cards WHERE key = ?", key)
+
+    def _fetch(self, sql: str, *params) -> Optional[tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _execute(self, sql: str, *params):
+        with self._lock, self._conn:
+            self._conn.execute(sql, params)
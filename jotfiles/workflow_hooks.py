@@ -21,13 +21,16 @@
 #  SOFTWARE.
 
 import logging
-from datetime import datetime
+import threading
+from datetime import timedelta
 
-from jotfiles.components import Calendar, PersonalBoard, Workflow
+from jotfiles.components import Calendar, PersonalBoard, Workflow, chunks
 from jotfiles.comunication import Chat, ScheduledMessagesPool
+from jotfiles.dispatch import MessageDispatcher
 from jotfiles.scrum import ScrumBoard
 
 logger = logging.getLogger(__name__)
+sync_chunk_size = 10
 
 
 # TODO change name
@@ -39,6 +42,7 @@ def __init__(
         smpool: ScheduledMessagesPool,
         chat: Chat,
         calendar: Calendar,
+        dispatcher: MessageDispatcher,
     ):
 
         self.board = board
@@ -46,20 +50,60 @@ def __init__(
         self.smpool = smpool
         self.chat = chat
         self.calendar = calendar
+        self.dispatcher = dispatcher
+        # the calendar keeps the state of a sync until it is committed, so
+        # overlapping syncs could commit each other's progress
+        self._events_lock = threading.Lock()
 
     def update_sprint_issues(self):
-        for task in self.board.current_sprint_tasks():
-            logger.info("Upserting sprint task {}", task.id)
-            self.p_space.upsert_task_card(task)
+        # chunks let the personal board batch its reads, while a failure stops the
+        # sync before the scrum board commits it
+        for tasks in chunks(self.board.updated_sprint_tasks(), sync_chunk_size):
+            logger.info("Upserting sprint tasks %s", [task.id for task in tasks])
+            report = self.p_space.upsert_task_cards(tasks)
+            failed = {key: error for key, error in report.items() if error}
+            if failed:
+                raise RuntimeError(f"Failed to upsert sprint tasks: {failed}")
+        self.board.commit_updates()
+        logger.info("Sprint issues updated: %s", self.p_space.pop_write_stats())
+
+    def archive_done(self, max_age: timedelta):
+        # cards of closed sprints are due before the end of the active one
+        try:
+            sprint_end = self.board.current_sprint().end_date
+        except LookupError:
+            logger.info("No active sprint, archiving done cards by age only")
+            sprint_end = None
+        self.p_space.archive_done(max_age, sprint_end)
 
     def send_scheduled_messages(self):
-        now = datetime.now()
-        for message in self.smpool.list_messages():
-            if message.schedule < now:
-                logger.info("Sending message to %s at %s", message.recipient, now)
-                self.chat.send_message(message)
+        # the dispatcher sends each message on time, this only feeds it new ones
+        poll = self.smpool.poll_messages()
+        if poll.gone:
+            logger.info("Cancelling %s deleted or edited messages", len(poll.gone))
+            self.dispatcher.cancel(poll.gone)
+        for message in poll.new:
+            logger.info(
+                "Scheduling message to %s at %s", message.recipient, message.schedule
+            )
+            self.dispatcher.schedule(message)
 
     def update_events(self):
-        for event in self.calendar.list_week_events():
-            logger.info("Upserting calendar event {}", event["summary"])
-            self.p_space.upsert_calendar_card(event)
+        with self._events_lock:
+            self._update_events()
+
+    def _update_events(self):
+        for events in chunks(self.calendar.updated_events(), sync_chunk_size):
+            for event in events:
+                if event.cancelled:
+                    logger.info("Archiving calendar event %s", event.id)
+                    self.p_space.archive_calendar_card(event)
+            logger.info("Upserting calendar events %s", [e.name for e in events])
+            report = self.p_space.upsert_calendar_cards(
+                event for event in events if not event.cancelled
+            )
+            failed = {key: error for key, error in report.items() if error}
+            if failed:
+                raise RuntimeError(f"Failed to upsert calendar events: {failed}")
+        self.calendar.commit_updates()
+        logger.info("Events updated: %s", self.p_space.pop_write_stats())
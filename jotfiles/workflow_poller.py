@@ -23,12 +23,15 @@
 
 import logging
 import time
+from datetime import timedelta
 from pathlib import Path
+from typing import Callable, Optional
 
 import schedule
 from pydantic import BaseSettings
 
 from jotfiles.container import Container
+from jotfiles.trello_m.ratelimit import limiter
 
 logger = logging.getLogger(__name__)
 
@@ -37,25 +40,94 @@ class Config(BaseSettings):
     personal_board: str = "trello"
     scrum_board: str = "jira"
     chat: str = "gchat"
+    calendar: str = "google"
     smpool: str = "trello"
     workflow_mode: str = "local"
     base_path: Path = Path()
     trello_credentials: Path = base_path / "credentials_trello.json"
+    trello_store: Path = base_path / "trello_cards.sqlite"
     jira_credentials: Path = base_path / "credentials_jira.json"
+    jira_watermarks: Path = base_path / "jira_watermarks.json"
+    jira_reconcile_hours: int = 24
+    # JIRA webhooks push changes as they happen, this is just a safety net
+    sprint_sync_hours: int = 6
+    # done cards without activity for this long are archived
+    archive_after_days: int = 30
+    sent_ledger: Path = base_path / "sent_messages.json"
+    # messages to the same thread due this close together are sent as a digest
+    message_coalesce_seconds: int = 0
+    # when set, trello pushes board changes to this jotfiles endpoint
+    trello_webhook_url: Optional[str] = None
+    google_token: Path = base_path / "google_token.json"
+    google_client_secrets: Path = base_path / "credentials.json"
+    calendar_email: Optional[str] = None
+    calendar_sync_state: Path = base_path / "calendar_sync.json"
+    calendar_reconcile_hours: int = 24
+    calendar_sync_minutes: int = 15
+    # when set, google pushes calendar changes to this jotfiles endpoint
+    calendar_webhook_url: Optional[str] = None
+    calendar_webhook_token: Optional[str] = None
+
+
+def _logged(job: Callable, *args):
+    # a failing job would stop the poller, and every other integration with it
+    try:
+        job(*args)
+    except Exception:
+        logger.exception("Scheduled job %s failed", job.__name__)
+
+
+def _synced(job: Callable, *args):
+    _logged(job, *args)
+    # syncs make most of the trello calls, so throttling is reported after each
+    logger.info("Trello rate limiter after %s: %s", job.__name__, limiter.stats())
 
 
 def bootstrap_poller():
 
+    started = time.perf_counter()
+    config = Config()
     container = Container()
-    container.config.from_pydantic(Config())
+    container.config.from_pydantic(config)
 
     workflow = container.workflow()
     personal_board = container.personal_board()
+    container.dispatcher().start()
+    logger.info("Components ready in %.2fs", time.perf_counter() - started)
 
     logger.info("Scheduling actions")
     # this should be dynamic / decoupled
-    schedule.every().hour.do(workflow.update_sprint_issues)
-    schedule.every().hour.do(personal_board.update_done)
+    schedule.every(config.sprint_sync_hours).hours.do(
+        _synced, workflow.update_sprint_issues
+    )
+    if config.trello_webhook_url:
+        if not personal_board.register_webhook(config.trello_webhook_url):
+            logger.warning("Trello webhook not created, it may already exist")
+        # webhooks complete done cards as they move, polling is just a safety net
+        schedule.every().day.do(_synced, personal_board.update_done)
+    else:
+        schedule.every().hour.do(_synced, personal_board.update_done)
+    schedule.every().minute.do(_logged, workflow.send_scheduled_messages)
+    if config.calendar_email and container.google_credentials().cached():
+        if config.calendar_webhook_url:
+            calendar = container.calendar()
+            channel = (config.calendar_webhook_url, config.calendar_webhook_token)
+            _logged(calendar.renew_watch, *channel)
+            # channels expire, a fresh one replaces each before that happens
+            schedule.every().hour.do(_logged, calendar.renew_watch, *channel)
+            # google pushes changes as they happen, polling is just a safety net
+            schedule.every(config.calendar_reconcile_hours).hours.do(
+                _synced, workflow.update_events
+            )
+        else:
+            schedule.every(config.calendar_sync_minutes).minutes.do(
+                _synced, workflow.update_events
+            )
+    else:
+        logger.warning("Google calendar is not set up, events will not be synced")
+    schedule.every().day.do(
+        _synced, workflow.archive_done, timedelta(days=config.archive_after_days)
+    )
     logger.info("All actions scheduled")
 
     while True: